@@ -656,7 +656,8 @@ def main():
                 header.append(column.column_name)
         enriched_content[record_type] = {
             "count": 0,
-            "content": [header]
+            "content": [header],
+            "empty_line": [""] * len(header)
         }
 
     if not os.path.isdir("tempfiles"):
@@ -704,8 +705,8 @@ def main():
                 value["content"].append(enriched_row)
                 value["count"] += 1
             else:
-                empty_line = ["" for x in value["content"][0]]
-                value["content"].append(empty_line)
+                # copy, the writer modifies rows in place
+                value["content"].append(value["empty_line"].copy())
     csv_file.close()
     for record_type, value in enriched_content.items():
         if value["count"] > 0:
@@ -18,8 +18,11 @@ def get_prefix(doi):
         response = urlopen(req)
         content_string = response.read()
         root = ET.fromstring(content_string)
-        result = root.findall(".//cr_qr:crm-item[@name='prefix-name']", {"cr_qr": "http://www.crossref.org/qrschema/3.0"})
-        return result[0].text
+        items = root.iter("{http://www.crossref.org/qrschema/3.0}crm-item")
+        result = next((item for item in items if item.get("name") == "prefix-name"), None)
+        if result is None:
+            return "No prefix-name found in Crossref data"
+        return result.text
     except HTTPError as httpe:
         code = str(httpe.getcode())
         return "HTTPError: {} - {}".format(code, httpe.reason)
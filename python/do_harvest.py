@@ -2,11 +2,16 @@
 # -*- coding: UTF-8 -*-
 
 import argparse
+import csv
 import datetime
+import itertools
 import os
+import shutil
+import sys
+import threading
 
 from collections import OrderedDict
-from csv import DictReader
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import openapc_toolkit as oat
 
@@ -17,12 +22,36 @@ ARG_HELP_STRINGS = {
     "output": 'Write raw harvested data to disk',
 }
 
-def integrate_changes(articles, file_path, enriched_file=False, dry_run=False):
+# Columns of a new harvest file
+DEFAULT_HEADER = list(oat.OAI_COLLECTION_CONTENT.keys())
+
+# Set on interruption, harvests still running will not touch any files afterwards
+STOP_HARVEST = threading.Event()
+
+def build_index(articles):
+    '''
+    Index harvested articles by their PID.
+
+    Args:
+        articles: A list of article dicts, as retured by openapc_toolkit.oai_harvest()
+    Returns:
+        An OrderedDict mapping PIDs to article dicts. Harvested articles use OAI
+        record IDs in the url field as PID, articles without a PID are left out.
+    '''
+    article_dict = OrderedDict()
+    for article in articles:
+        url = article["url"]
+        if oat.has_value(url):
+            article_dict[url] = article
+    return article_dict
+
+def integrate_changes(article_dict, file_path, enriched_file=False, dry_run=False):
     '''
     Update existing entries in a previously created harvest file.
     
     Args:
-        articles: A list of article dicts, as retured by openapc_toolkit.oai_harvest()
+        article_dict: An index of harvested articles, as returned by build_index().
+                      It is not modified, so it can be reused for several files.
         file_path: Path to the CSV file the new values should be integrated into.
         enriched_file: If true, columns which are overwritten during enrichment
                        will not be updated
@@ -30,9 +59,9 @@ def integrate_changes(articles, file_path, enriched_file=False, dry_run=False):
                  return the list of unencountered articles)
     Returns:
         A tuple. The first element is a reduced list of article dicts, containing
-        those which did not find a matching DOI in the file (Order preserved).
+        those which did not find a matching PID in the file (Order preserved).
         The second element is the list of column headers encountered in the harvest 
-        file.
+        file. If the file does not exist, the tuple is (None, None).
     '''
 
     messages = {
@@ -51,86 +80,154 @@ def integrate_changes(articles, file_path, enriched_file=False, dry_run=False):
     messages = messages['dry'] if dry_run else messages['wet']
 
     if not os.path.isfile(file_path):
-        return (articles, None)
-    enriched_blacklist = ["institution", "publisher", "journal_full_title", "issn", "license_ref", "pmid"]
-    article_dict = OrderedDict()
-    for article in articles:
-        # Harvested articles use OAI record IDs in the url field as PID.
-        url = article["url"]
-        if oat.has_value(url):
-            article_dict[url] = article
-    updated_lines = []
-    fieldnames = None
+        return (None, None)
+    enriched_blacklist = frozenset(["institution", "publisher", "journal_full_title", "issn", "license_ref", "pmid"])
+    consumed = set()
+    tmp_path = file_path + ".tmp"
     with open(file_path, "r") as f:
-        reader = DictReader(f)
-        fieldnames = reader.fieldnames
-        updated_lines.append(list(fieldnames)) #header
+        reader = csv.reader(f)
+        fieldnames = next(reader)
+        field_index = {key: index for index, key in enumerate(fieldnames)}
+        url_index = field_index["url"]
+        institution_index = field_index["institution"]
+        # Columns which may be updated, with blacklisted ones already left out
+        compare_columns = [(key, index) for key, index in field_index.items()
+                           if not (enriched_file and key in enriched_blacklist)]
         oat.print_y(messages["start"].format(file_path))
-        for line in reader:
-            url = line["url"]
-            if not oat.has_value(line["institution"]):
-                # Do not change empty lines
-                updated_lines.append([line[key] for key in fieldnames])
-                continue
-            line_num = reader.reader.line_num
-            if url in article_dict:
-                for key, value in article_dict[url].items():
-                    if enriched_file and key in enriched_blacklist:
-                        continue
-                    if key in line and value != line[key]:
-                        oat.print_g(messages["line_change"].format(line_num, line["url"], key, line[key], value))
-                        line[key] = value
-                del(article_dict[url])
-                updated_line = [line[key] for key in fieldnames]
-                updated_lines.append(updated_line)
-            else:
-                oat.print_r(messages["remove"].format(url))
+
+        def updated_lines():
+            # Local names for functions called per row
+            has_value = oat.has_value
+            print_g = oat.print_g
+            print_r = oat.print_r
+            yield list(fieldnames) #header
+            for row in reader:
+                if not row:
+                    continue
+                url = row[url_index]
+                if not has_value(row[institution_index]):
+                    # Do not change empty lines
+                    yield row
+                    continue
+                line_num = reader.line_num
+                if url in article_dict and url not in consumed:
+                    article = article_dict[url]
+                    for key, index in compare_columns:
+                        value = article.get(key)
+                        if value is not None and value != row[index]:
+                            print_g(messages["line_change"].format(line_num, url, key, row[index], value))
+                            row[index] = value
+                    consumed.add(url)
+                    yield row
+                else:
+                    print_r(messages["remove"].format(url))
+
+        if dry_run:
+            for _ in updated_lines():
+                pass
+        else:
+            # Rows are streamed into a temporary file which replaces the original one afterwards
+            try:
+                with open(tmp_path, "w") as out:
+                    mask = oat.OPENAPC_STANDARD_QUOTEMASK if enriched_file else None
+                    writer = oat.OpenAPCUnicodeWriter(out, quotemask=mask, openapc_quote_rules=True, has_header=True)
+                    writer.write_rows(updated_lines())
+                # Keep the permissions of the original file
+                shutil.copymode(file_path, tmp_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
     if not dry_run:
-        with open(file_path, "w") as f:
-            mask = oat.OPENAPC_STANDARD_QUOTEMASK if enriched_file else None
-            writer = oat.OpenAPCUnicodeWriter(f, quotemask=mask, openapc_quote_rules=True, has_header=True)
-            writer.write_rows(updated_lines)
-    return (article_dict.values(), fieldnames)
+        os.replace(tmp_path, file_path)
+    unmatched = [article for url, article in article_dict.items() if url not in consumed]
+    return (unmatched, fieldnames)
     
 
+def harvest_source(line, args, date_string):
+    '''
+    Harvest a single OAI-PMH source and integrate the results.
+
+    Args:
+        line: A row from harvest_list.csv (as dict)
+        args: The parsed command line arguments
+        date_string: The current date, used in the name of the new articles file
+    '''
+    basic_url = line["basic_url"]
+    oat.print_g("Starting harvest from source " + basic_url)
+    oai_set = line["oai_set"] if len(line["oai_set"]) > 0 else None
+    prefix = line["metadata_prefix"] if len(line["metadata_prefix"]) > 0 else None
+    processing = line["processing"] if len(line["processing"]) > 0 else None
+    directory = os.path.join("..", line["directory"])
+    out_file_suffix = os.path.basename(line["directory"]) if args.output else None
+    articles = oat.oai_harvest(basic_url, prefix, oai_set, processing, out_file_suffix)
+    if STOP_HARVEST.is_set():
+        oat.print_y("Harvest from source " + basic_url + " interrupted, files left unchanged")
+        return
+    harvest_file_path = os.path.join(directory, "all_harvested_articles.csv")
+    enriched_file_path = os.path.join(directory, "all_harvested_articles_enriched.csv")
+    article_index = build_index(articles)
+    new_article_dicts, header = integrate_changes(article_index, harvest_file_path, False, not args.integrate)
+    integrate_changes(article_index, enriched_file_path, True, not args.integrate)
+    if header is None:
+        # if no header was returned, an "all_harvested" file doesn't exist yet
+        # copy, the writer quotes header values in place
+        header = list(DEFAULT_HEADER)
+        new_article_dicts = articles
+    # Rows are generated while being written instead of being collected first
+    # The writer quotes the header list in place, so the rows use a copy of the keys
+    keys = tuple(header)
+    new_articles = itertools.chain([header], ([article[key] for key in keys] for article in new_article_dicts))
+    file_name = "new_articles_" + date_string + ".csv"
+    target = os.path.join(directory, file_name)
+    with open(target, "w") as t:
+        writer = oat.OpenAPCUnicodeWriter(t, openapc_quote_rules=True, has_header=True)
+        writer.write_rows(new_articles)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--integrate", help=ARG_HELP_STRINGS["integrate"], action="store_true")
     parser.add_argument("-o", "--output", help=ARG_HELP_STRINGS["output"], action="store_true")
     args = parser.parse_args()
 
+    sources = []
+    inactive_urls = []
     with open("harvest_list.csv", "r") as harvest_list:
-        reader = DictReader(harvest_list)
+        reader = csv.DictReader(harvest_list)
         for line in reader:
-            basic_url = line["basic_url"]
             if line["active"] == "TRUE":
-                oat.print_g("Starting harvest from source " + basic_url)
-                oai_set = line["oai_set"] if len(line["oai_set"]) > 0 else None
-                prefix = line["metadata_prefix"] if len(line["metadata_prefix"]) > 0 else None
-                processing = line["processing"] if len(line["processing"]) > 0 else None
-                directory = os.path.join("..", line["directory"])
-                out_file_suffix = os.path.basename(line["directory"]) if args.output else None
-                articles = oat.oai_harvest(basic_url, prefix, oai_set, processing, out_file_suffix)
-                harvest_file_path = os.path.join(directory, "all_harvested_articles.csv")
-                enriched_file_path = os.path.join(directory, "all_harvested_articles_enriched.csv")
-                new_article_dicts, header = integrate_changes(articles, harvest_file_path, False, not args.integrate)
-                integrate_changes(articles, enriched_file_path, True, not args.integrate)
-                if header is None:
-                    # if no header was returned, an "all_harvested" file doesn't exist yet
-                    header = list(oat.OAI_COLLECTION_CONTENT.keys())
-                new_articles = [header]
-                for article_dict in new_article_dicts:
-                    new_articles.append([article_dict[key] for key in header])
-                now = datetime.datetime.now()
-                date_string = now.strftime("%Y_%m_%d")
-                file_name = "new_articles_" + date_string + ".csv"
-                target = os.path.join(directory, file_name)
-                with open(target, "w") as t:
-                    writer = oat.OpenAPCUnicodeWriter(t, openapc_quote_rules=True, has_header=True)
-                    writer.write_rows(new_articles)
+                sources.append(line)
             else:
-                oat.print_y("Skipping inactive source " + basic_url)
-            
+                inactive_urls.append(line["basic_url"])
+    if inactive_urls:
+        oat.print_y("Skipping {} inactive source(s): {}".format(len(inactive_urls), ", ".join(inactive_urls)))
+    if not sources:
+        return
+    date_string = datetime.datetime.now().strftime("%Y_%m_%d")
+    # Sources are independent and harvesting is network-bound, so run them concurrently
+    failed_urls = []
+    with ThreadPoolExecutor(max_workers=min(8, len(sources))) as executor:
+        futures = {executor.submit(harvest_source, line, args, date_string): line["basic_url"]
+                   for line in sources}
+        try:
+            for future in as_completed(futures):
+                basic_url = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failed_urls.append(basic_url)
+                    oat.print_r("Harvest from source {} failed: {}: {}".format(basic_url, type(e).__name__, e))
+        except KeyboardInterrupt:
+            # Threads cannot be stopped, but queued harvests can be dropped
+            # (shutdown(cancel_futures=True) needs Python 3.9)
+            STOP_HARVEST.set()
+            for future in futures:
+                future.cancel()
+            oat.print_r("Interrupted, waiting for running harvests to finish without changing files...")
+            raise
+    if failed_urls:
+        oat.print_r("{} source(s) failed: {}".format(len(failed_urls), ", ".join(failed_urls)))
+        sys.exit(1)
+
     
 if __name__ == '__main__':
     main()
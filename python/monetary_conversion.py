@@ -4,10 +4,12 @@
 import argparse
 import codecs
 import datetime
+import json
 import locale
 from os import path
 import re
 import sys
+import time
 
 import openapc_toolkit as oat
 
@@ -17,6 +19,9 @@ EXCHANGE_RATES = {
     "A": {} 
 }
 
+# Cached exchange rates older than this (in seconds) will not be used
+EXCHANGE_RATES_CACHE_MAX_AGE = 24 * 60 * 60
+
 ARG_HELP_STRINGS = {
     "encoding": "The encoding of the source file.",
     "quotemask": "A quotemask to apply to the result file after the conversion " +
@@ -35,6 +40,12 @@ ARG_HELP_STRINGS = {
               "CSV file was created in (Example: Using en_US as your system " +
               "locale might become a problem if the file contains monetary " +
               "values with ',' as decimal mark character)",
+    "exchange_rates_cache_file": "A JSON file to cache ECB exchange rates in " +
+                                 "between runs (for example " +
+                                 "'_monetary_conversion_rates_cache.json'). " +
+                                 "Cached rates are reused for one day, after " +
+                                 "that they are queried again. No cache is " +
+                                 "used if omitted.",
 }
 
 YEARLY_RE = re.compile("^\d\d\d\d$")
@@ -73,6 +84,42 @@ def _calulate_preliminary_annual_average(year, currency):
         oat.print_r(msg.format(year))
         return None
 
+def load_exchange_rates_cache(cache_file):
+    """
+    Fill EXCHANGE_RATES from a cache file, if it is recent enough.
+
+    Returns:
+        The creation timestamp of the cached rates or None if no cache was used.
+    """
+    if not path.isfile(cache_file):
+        return None
+    with open(cache_file, "r") as f:
+        try:
+            cache = json.loads(f.read())
+            created = cache["created"]
+            rates = cache["rates"]
+            if not isinstance(created, (int, float)) or not isinstance(rates, dict):
+                raise TypeError("unexpected cache layout")
+            cached_rates = {frequency: rates.get(frequency, {}) for frequency in EXCHANGE_RATES}
+            if not all(isinstance(value, dict) for value in cached_rates.values()):
+                raise TypeError("unexpected cache layout")
+        except (ValueError, KeyError, TypeError):
+            oat.print_r("Could not decode a cache structure from " + cache_file + ", starting with an empty cache.")
+            return None
+    if time.time() - created > EXCHANGE_RATES_CACHE_MAX_AGE:
+        oat.print_y("Exchange rates cache " + cache_file + " is outdated, querying ECB data warehouse instead.")
+        return None
+    for frequency, frequency_rates in cached_rates.items():
+        EXCHANGE_RATES[frequency].update(frequency_rates)
+    oat.print_g("Using cached exchange rates from " + cache_file)
+    return created
+
+def save_exchange_rates_cache(cache_file, created):
+    # Keep the original creation time, so rates added later do not extend the lifetime of older ones
+    cache = {"created": created, "rates": EXCHANGE_RATES}
+    with open(cache_file, "w") as f:
+        f.write(json.dumps(cache, sort_keys=True, indent=4, separators=(',', ': ')))
+
 def get_next_day(date_string):
     day = datetime.datetime.strptime(date_string, "%Y-%m-%d")
     next_day = day + datetime.timedelta(days=1)
@@ -92,6 +139,7 @@ def main():
     parser.add_argument("-o", "--openapc_quote_rules", 
                         help=ARG_HELP_STRINGS["openapc_quote_rules"],
                         action="store_true", default=False)
+    parser.add_argument("-c", "--exchange_rates_cache_file", help=ARG_HELP_STRINGS["exchange_rates_cache_file"])
     args = parser.parse_args()
     
     quote_rules = args.openapc_quote_rules
@@ -146,6 +194,12 @@ def main():
         msg = "Column {} ('{}') is the {}."
         oat.print_g(msg.format(index, fieldnames[index], column_type))
     
+    cache_created = None
+    if args.exchange_rates_cache_file:
+        cache_created = load_exchange_rates_cache(args.exchange_rates_cache_file)
+    if cache_created is None:
+        cache_created = time.time()
+
     start = input("\nStart conversion? (y/n):")
     while start not in ["y", "n"]:
         start = input("Please type 'y' or 'n':")
@@ -224,6 +278,8 @@ def main():
     with open('out.csv', 'w') as out:
         writer = oat.OpenAPCUnicodeWriter(out, mask, quote_rules, True)
         writer.write_rows([fieldnames] + modified_content)
+    if args.exchange_rates_cache_file:
+        save_exchange_rates_cache(args.exchange_rates_cache_file, cache_created)
 
 if __name__ == '__main__' and __package__ is None:
     sys.path.append(path.dirname(path.dirname(path.dirname(path.dirname(path.abspath(__file__))))))
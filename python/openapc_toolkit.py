@@ -3,6 +3,8 @@
 
 import csv
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import gzip
 from html import unescape
 from http.client import RemoteDisconnected
 import json
@@ -10,13 +12,18 @@ import locale
 import logging
 from logging.handlers import MemoryHandler
 import os
+import queue
 import re
 from shutil import copyfileobj
 import sys
+import threading
+import time
 from urllib.parse import quote_plus, urlencode
 from urllib.request import build_opener, urlopen, urlretrieve, HTTPErrorProcessor, Request
 from urllib.error import HTTPError, URLError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import xml.etree.ElementTree as ET
 
 import mappings
@@ -45,20 +52,60 @@ SHORTDOI_RE = re.compile(r"^(https?://)?(dx.)?doi.org/(?P<shortdoi>[a-z0-9]+)$",
 
 ISSN_RE = re.compile(r"^(?P<first_part>\d{4})\-(?P<second_part>\d{3})(?P<check_digit>[\dxX])$")
 
-OAI_COLLECTION_CONTENT = OrderedDict([
-    ("institution", "intact:institution"),
-    ("period", "intact:period"),
-    ("euro", "intact:euro"),
-    ("doi", "intact:id_number[@type='doi']"),
-    ("is_hybrid", "intact:is_hybrid"),
-    ("publisher", "intact:publisher"),
-    ("journal_full_title", "intact:journal_full_title"),
-    ("issn", "intact:issn"),
-    ("license_ref", "intact:licence"),
-    ("pmid", "intact:id_number[@type='pubmed']"),
-    ("url", None),
-    ("local_id", "intact:id_number[@type='local']")
-])
+# regex for the element paths in OAI_COLLECTION_CONTENT (intact:tag, optionally with a type predicate)
+OAI_COLLECTION_PATH_RE = re.compile(r"^intact:(?P<tag>\w+)(?:\[@type='(?P<type>\w+)'\])?$")
+
+OAI_COLLECTION_CONTENT = {
+    "institution": "intact:institution",
+    "period": "intact:period",
+    "euro": "intact:euro",
+    "doi": "intact:id_number[@type='doi']",
+    "is_hybrid": "intact:is_hybrid",
+    "publisher": "intact:publisher",
+    "journal_full_title": "intact:journal_full_title",
+    "issn": "intact:issn",
+    "license_ref": "intact:licence",
+    "pmid": "intact:id_number[@type='pubmed']",
+    "url": None,
+    "local_id": "intact:id_number[@type='local']"
+}
+
+# Namespaces of OAI-PMH records in Clark notation ({uri}tag). Element paths
+# built from these do not need a prefix mapping to be resolved on every lookup.
+OAI_NS = "{http://www.openarchives.org/OAI/2.0/}"
+INTACT_NS = "{http://intact-project.org}"
+
+# Connect and read timeout (in seconds) for OAI-PMH requests. The read timeout
+# applies to every chunk, so a stalled transfer fails instead of blocking forever.
+OAI_REQUEST_TIMEOUT = (10, 120)
+
+def _map_oai_collection_children(collection_content):
+    """
+    Map the child elements of an INTACT collection to article fields.
+
+    Args:
+        collection_content: A dict of article fields to element paths relative
+                            to the collection (like OAI_COLLECTION_CONTENT).
+    Returns:
+        A dict mapping (tag, type attribute) tuples to field names. Tags are in
+        Clark notation, the type is None for paths without a type predicate.
+    Raises:
+        ValueError: A path is not of the form intact:tag or intact:tag[@type='x'].
+    """
+    children = {}
+    for elem, xpath in collection_content.items():
+        if xpath is not None:
+            match = OAI_COLLECTION_PATH_RE.match(xpath)
+            if match is None:
+                msg = 'Unsupported element path for OAI collection field "{}": "{}"'
+                raise ValueError(msg.format(elem, xpath))
+            children[(INTACT_NS + match["tag"], match["type"])] = elem
+    return children
+
+_OAI_COLLECTION_CHILDREN = _map_oai_collection_children(OAI_COLLECTION_CONTENT)
+
+# Article fields in their initial state, copied for every harvested record
+_OAI_ARTICLE_TEMPLATE = dict.fromkeys(OAI_COLLECTION_CONTENT, "NA")
 
 MESSAGES = {
     "num_columns": "Syntax: The number of values in this row (%s) " +
@@ -170,6 +217,9 @@ COLUMN_SCHEMAS = {
     ]
 }
 
+# Serializes console output of the print_* functions when used from several threads
+PRINT_LOCK = threading.Lock()
+
 INSTITUTIONS_FILE = "../data/institutions.csv"
 INSTITUTIONS_MAP = None
 
@@ -207,20 +257,21 @@ class OpenAPCUnicodeWriter(object):
         self.has_header = has_header
         self.minimal_quotes = minimal_quotes
 
+    OPENAPC_KEYWORDS = frozenset(["TRUE", "FALSE", "NA"])
+
     def _prepare_row(self, row, use_quotemask):
-        for index in range(len(row)):
-            if self.openapc_quote_rules and row[index] in ["TRUE", "FALSE", "NA"]:
+        keywords = self.OPENAPC_KEYWORDS if self.openapc_quote_rules else frozenset()
+        quotemask = self.quotemask if use_quotemask else None
+        for index, value in enumerate(row):
+            if value in keywords:
                 # Never quote these keywords
                 continue
-            if not use_quotemask or not self.quotemask:
+            if not quotemask:
                 # Always quote without a quotemask
-                row[index] = row[index].replace('"', '""')
-                row[index] = '"' + row[index] + '"'
-                continue
-            if index < len(self.quotemask):
-                if self.quotemask[index] or "," in row[index] and self.minimal_quotes:
-                    row[index] = row[index].replace('"', '""')
-                    row[index] = '"' + row[index] + '"'
+                row[index] = '"' + value.replace('"', '""') + '"'
+            elif index < len(quotemask):
+                if quotemask[index] or "," in value and self.minimal_quotes:
+                    row[index] = '"' + value.replace('"', '""') + '"'
         return row
 
     def _write_row(self, row):
@@ -228,8 +279,12 @@ class OpenAPCUnicodeWriter(object):
         self.outfile.write(line)
 
     def write_rows(self, rows):
+        # rows may be any iterable, so they can be written while being generated
+        rows = iter(rows)
         if self.has_header:
-            self._write_row(self._prepare_row(rows.pop(0), False))
+            header = next(rows, None)
+            if header is not None:
+                self._write_row(self._prepare_row(header, False))
         for row in rows:
             self._write_row(self._prepare_row(row, True))
 
@@ -472,14 +527,20 @@ class ISBNHandling(object):
     def __init__(self, range_file_path, range_file_update=False):
         if not os.path.isfile(range_file_path) or range_file_update:
             self.download_range_file(range_file_path)
-        with open(range_file_path, "r") as range_file:
-            range_file_content = range_file.read()
-            range_file_root = ET.fromstring(range_file_content)
-            self.ean_elements = range_file_root.findall("./EAN.UCCPrefixes/EAN.UCC")
-            self.registration_groups = range_file_root.findall("./RegistrationGroups/Group")
+        range_file_root = ET.parse(range_file_path).getroot()
+        self.ean_elements = range_file_root.findall("./EAN.UCCPrefixes/EAN.UCC")
+        self.registration_groups = range_file_root.findall("./RegistrationGroups/Group")
 
     def download_range_file(self, target):
-        urlretrieve("http://www.isbn-international.org/export_rangemessage.xml", target)
+        # The RangeMessage XML compresses well, so ask for a gzipped transfer
+        request = Request("http://www.isbn-international.org/export_rangemessage.xml")
+        request.add_header("Accept-Encoding", "gzip")
+        with urlopen(request) as response:
+            source = response
+            if response.headers.get("Content-Encoding") == "gzip":
+                source = gzip.GzipFile(fileobj=response)
+            with open(target, "wb") as out:
+                copyfileobj(source, out)
 
     def test_and_normalize_isbn(self, isbn):
         """
@@ -884,92 +945,208 @@ def get_csv_file_content(file_name, enc=None, force_header=False, print_results=
 def has_value(field):
     return len(field) > 0 and field != "NA"
 
+def _get_oai_session():
+    """
+    Create a HTTP session for harvesting a single OAI-PMH repository.
+
+    The session keeps the connection to the repository alive between
+    resumptionToken requests, negotiates gzip/deflate compression and retries
+    requests on temporary server errors. OAI-PMH repositories use 503 responses
+    with a Retry-After header for flow control, this delay is honored.
+    """
+    retries = Retry(total=5, backoff_factor=1.0, status_forcelist=[429, 500, 502, 503, 504],
+                    respect_retry_after_header=True)
+    session = requests.Session()
+    # OAI-PMH XML compresses well, responses are decoded transparently by requests
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.mount("http://", HTTPAdapter(pool_maxsize=4, max_retries=retries))
+    session.mount("https://", HTTPAdapter(pool_maxsize=4, max_retries=retries))
+    return session
+
+def _fetch_oai_page(session, url, chunk_queue):
+    """
+    Download an OAI-PMH response and pass it on in chunks.
+
+    Intended to run in a background thread, so the response can be parsed
+    while it is still being downloaded.
+
+    Args:
+        session: A requests session, as returned by _get_oai_session()
+        url: The request URL
+        chunk_queue: A queue.Queue the response content is put on as byte
+                     chunks, followed by None. If the download fails for
+                     any reason, the exception is put on the queue instead.
+    """
+    try:
+        with session.get(url, stream=True, timeout=OAI_REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=65536):
+                chunk_queue.put(chunk)
+    except BaseException as e:
+        # Any failure has to reach the consumer, it would wait forever otherwise
+        chunk_queue.put(e)
+        return
+    chunk_queue.put(None)
+
+def _extract_oai_article(record, instruction=None):
+    """
+    Extract an OpenAPC article from an OAI-PMH record.
+
+    Args:
+        record: An ElementTree Element representing an OAI-PMH record.
+        instruction: An optional processing instruction as a tuple
+                     (target, generator, variables). The generator string
+                     will be written to the target column, with every
+                     %variable% replaced by the according article value.
+    Returns:
+        An article dict or None if the record has no content or no APC amount.
+    """
+    collection_xpath = "./" + OAI_NS + "metadata//" + INTACT_NS + "collection"
+    identifier_xpath = "./" + OAI_NS + "header/" + OAI_NS + "identifier"
+    article = {}
+    identifier = record.find(identifier_xpath)
+    article["identifier"] = identifier.text
+    collection = record.find(collection_xpath)
+    if collection is None:
+        # Might happen with deleted records
+        return None
+    article.update(_OAI_ARTICLE_TEMPLATE)
+    # Walk the children once instead of searching them for every field. Like
+    # with find(), the first matching child determines the value.
+    found = set()
+    for child in collection:
+        elem = _OAI_COLLECTION_CHILDREN.get((child.tag, child.get("type")))
+        if elem is None:
+            elem = _OAI_COLLECTION_CHILDREN.get((child.tag, None))
+        if elem is None or elem in found:
+            continue
+        found.add(elem)
+        if child.text is not None:
+            article[elem] = child.text
+    if instruction:
+        target, generator, variables = instruction
+        target_string = generator
+        for variable in variables:
+            target_string = target_string.replace("%" + variable + "%", article[variable])
+        article[target] = target_string
+    if article["euro"] in ["NA", "0"]:
+        print_r("Article skipped, no APC amount found.")
+        return None
+    if article["doi"] != "NA":
+        norm_doi = get_normalised_DOI(article["doi"])
+        if norm_doi is None:
+            article["doi"] = "NA"
+        else:
+            article["doi"] = norm_doi
+    return article
+
+def _parse_oai_processing_instruction(processing):
+    """
+    Parse a processing instruction of the form 'target':'generator'.
+
+    Args:
+        processing: The instruction string. The generator may contain any
+                    number of %variable% placeholders referring to article fields.
+    Returns:
+        A tuple (target, generator, variables) as expected by
+        _extract_oai_article() or None if the instruction could not be parsed.
+    """
+    processing_regex = re.compile(r"'(?P<target>\w*)':'(?P<generator>.*)'")
+    variable_regex = re.compile(r"%(\w+?)%")
+    match = processing_regex.fullmatch(processing)
+    if not match:
+        print_r("Error: Unable to parse processing instruction!")
+        return None
+    generator = match["generator"]
+    variables = tuple(variable_regex.findall(generator))
+    return (match["target"], generator, variables)
+
 def oai_harvest(basic_url, metadata_prefix=None, oai_set=None, processing=None, out_file_suffix=None):
     """
     Harvest OpenAPC records via OAI-PMH
+
+    Responses are parsed incrementally. Every record is detached from its
+    ListRecords parent after extraction, so memory usage does not grow with
+    the page size.
     """
-    collection_xpath = ".//oai_2_0:metadata//intact:collection"
-    record_xpath = ".//oai_2_0:record"
-    identifier_xpath = ".//oai_2_0:header//oai_2_0:identifier"
-    token_xpath = ".//oai_2_0:resumptionToken"
-    processing_regex = re.compile(r"'(?P<target>\w*?)':'(?P<generator>.*?)'")
-    variable_regex = re.compile(r"%(\w*?)%")
-    #institution_xpath =
-    namespaces = {
-        "oai_2_0": "http://www.openarchives.org/OAI/2.0/",
-        "intact": "http://intact-project.org"
-    }
+    record_tag = OAI_NS + "record"
+    list_records_tag = OAI_NS + "ListRecords"
+    token_tag = OAI_NS + "resumptionToken"
     url = basic_url + "?verb=ListRecords"
     if metadata_prefix:
         url += "&metadataPrefix=" + metadata_prefix
     if oai_set:
         url += "&set=" + oai_set
+    instruction = None
     if processing:
-        match = processing_regex.match(processing)
-        if match:
-            groupdict = match.groupdict()
-            target = groupdict["target"]
-            generator = groupdict["generator"]
-            variables = variable_regex.search(generator).groups()
-        else:
-            print_r("Error: Unable to parse processing instruction!")
-            processing = None
+        instruction = _parse_oai_processing_instruction(processing)
     print_b("Harvesting from " + url)
     articles = []
-    file_output = ""
-    while url is not None:
-        try:
-            request = Request(url)
-            url = None
-            response = urlopen(request)
-            content_string = response.read()
-            if out_file_suffix:
-                file_output += content_string.decode()
-            root = ET.fromstring(content_string)
-            records = root.findall(record_xpath, namespaces)
-            counter = 0
-            for record in records:
-                article = {}
-                identifier = record.find(identifier_xpath, namespaces)
-                article["identifier"] = identifier.text
-                collection = record.find(collection_xpath, namespaces)
-                if collection is None:
-                    # Might happen with deleted records
-                    continue
-                for elem, xpath in OAI_COLLECTION_CONTENT.items():
-                    article[elem] = "NA"
-                    if xpath is not None:
-                        result = collection.find(xpath, namespaces)
-                        if result is not None and result.text is not None:
-                            article[elem] = result.text
-                if processing:
-                    target_string = generator
-                    for variable in variables:
-                        target_string = target_string.replace("%" + variable + "%", article[variable])
-                    article[target] = target_string
-                if article["euro"] in ["NA", "0"]:
-                    print_r("Article skipped, no APC amount found.")
-                    continue
-                if article["doi"] != "NA":
-                    norm_doi = get_normalised_DOI(article["doi"])
-                    if norm_doi is None:
-                        article["doi"] = "NA"
-                    else:
-                        article["doi"] = norm_doi
-                articles.append(article)
-                counter += 1
-            token = root.find(token_xpath, namespaces)
-            if token is not None and token.text is not None:
-                url = basic_url + "?verb=ListRecords&resumptionToken=" + token.text
-            print_g(str(counter) + " articles harvested.")
-        except HTTPError as httpe:
-            code = str(httpe.getcode())
-            print("HTTPError: {} - {}".format(code, httpe.reason))
-        except URLError as urle:
-            print("URLError: {}".format(urle.reason))
+    file_output_chunks = []
+    max_page_retries = 5
+    page_retries = 0
+    with _get_oai_session() as session, ThreadPoolExecutor(max_workers=1) as executor:
+        while url is not None:
+            try:
+                # A new queue per page, so leftovers of an aborted page cannot leak in
+                chunk_queue = queue.Queue()
+                executor.submit(_fetch_oai_page, session, url, chunk_queue)
+                parser = ET.XMLPullParser(events=("start", "end"))
+                list_records = None
+                token = None
+                # Page results are only kept once the page was received completely
+                page_articles = []
+                page_chunks = []
+                for chunk in iter(chunk_queue.get, None):
+                    if isinstance(chunk, BaseException):
+                        raise chunk
+                    parser.feed(chunk)
+                    if out_file_suffix:
+                        page_chunks.append(chunk)
+                    for event, elem in parser.read_events():
+                        if event == "start":
+                            if elem.tag == list_records_tag:
+                                list_records = elem
+                        elif elem.tag == token_tag:
+                            token = elem.text
+                        elif elem.tag == record_tag:
+                            article = _extract_oai_article(elem, instruction)
+                            # Drop the processed record. ElementTree has no parent
+                            # links, so it has to be removed via ListRecords.
+                            elem.clear()
+                            if list_records is not None:
+                                list_records.remove(elem)
+                            if article is not None:
+                                page_articles.append(article)
+                parser.close()
+                articles += page_articles
+                file_output_chunks += page_chunks
+                page_retries = 0
+                url = None
+                if token is not None:
+                    url = basic_url + "?verb=ListRecords&resumptionToken=" + token
+                print_g(str(len(page_articles)) + " articles harvested.")
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                # The connection broke down or stalled during the transfer (a read
+                # timeout while streaming arrives as ConnectionError). Retry the
+                # page instead of discarding the whole harvest.
+                page_retries += 1
+                if page_retries > max_page_retries:
+                    print_r("{}: {}".format(type(e).__name__, e))
+                    url = None
+                else:
+                    print_y("Transfer interrupted, retrying page ({}/{})".format(page_retries, max_page_retries))
+                    time.sleep(2 ** page_retries)
+            except requests.exceptions.HTTPError as httpe:
+                code = str(httpe.response.status_code)
+                print_r("HTTPError: {} - {}".format(code, httpe.response.reason))
+                url = None
+            except requests.exceptions.RequestException as reqe:
+                print_r("RequestException: {}".format(reqe))
+                url = None
     if out_file_suffix:
-        with open("raw_harvest_data_" + out_file_suffix, "w") as out:
-            out.write(file_output)
+        with open("raw_harvest_data_" + out_file_suffix, "wb") as out:
+            out.write(b"".join(file_output_chunks))
     return articles
 
 def find_book_dois_in_crossref(isbn_list):
@@ -1332,16 +1509,16 @@ def get_metadata_from_pubmed(doi_string):
     ret_value = {'success': True}
     try:
         request = requests.get(url)
-        root = ET.fromstring(request.text)
+        root = ET.fromstring(request.content)
         pubmed_data = {}
         xpaths = {
             "pmid": ".//resultList/result/pmid",
             "pmcid": ".//resultList/result/pmcid",
         }
         for elem, path in xpaths.items():
-            result = root.findall(path)
-            if result:
-                pubmed_data[elem] = result[0].text
+            result = root.find(path)
+            if result is not None:
+                pubmed_data[elem] = result.text
             else:
                 pubmed_data[elem] = None
         ret_value['data'] = pubmed_data
@@ -1426,8 +1603,25 @@ def _process_euro_value(euro_value, round_monetary, row_num, index, offsetting_m
         logging.error(msg, row_num, euro_value, index)
         return "NA"
 
+def _is_period_date(value):
+    """
+    Check if a period value is given as a date (YYYY-MM or YYYY-MM-DD).
+
+    Plain string indexing is used instead of a regex since this is tested for
+    every row.
+    """
+    length = len(value)
+    if length != 7 and length != 10:
+        return False
+    if not (value[4] == "-" and value[:4].isdecimal() and value[5] in "01" and
+            value[6].isdecimal()):
+        return False
+    if length == 10:
+        return value[7] == "-" and value[8] in "0123" and value[9].isdecimal()
+    return True
+
 def _process_period_value(period_value, row_num):
-    if re.match(r"^\d{4}-[0-1]{1}\d(-[0-3]{1}\d)?$", period_value):
+    if _is_period_date(period_value):
         msg = "Line %s: " + MESSAGES["period_format"]
         new_value = period_value[:4]
         logging.info(msg, row_num, period_value, new_value)
@@ -1912,16 +2106,21 @@ def colorize(text, color):
     return ANSI_COLORS[color] + text + "\033[0m"
 
 def print_b(text):
-    print(colorize(text, "blue"))
+    with PRINT_LOCK:
+        print(colorize(text, "blue"))
 
 def print_g(text):
-    print(colorize(text, "green"))
+    with PRINT_LOCK:
+        print(colorize(text, "green"))
 
 def print_r(text):
-    print(colorize(text, "red"))
+    with PRINT_LOCK:
+        print(colorize(text, "red"))
 
 def print_y(text):
-    print(colorize(text, "yellow"))
+    with PRINT_LOCK:
+        print(colorize(text, "yellow"))
 
 def print_c(text):
-    print(colorize(text, "cyan"))
+    with PRINT_LOCK:
+        print(colorize(text, "cyan"))
@@ -0,0 +1,45 @@
+# -*- coding: UTF-8 -*-
+
+import os
+from sys import path
+import xml.etree.ElementTree as ET
+
+import pytest
+
+path.append(os.path.join(path[0], "python"))
+import openapc_toolkit as oat
+
+OAI_RECORD = """
+<record xmlns="http://www.openarchives.org/OAI/2.0/">
+    <header>
+        <identifier>oai:example.org:42</identifier>
+    </header>
+    <metadata>
+        <intact:collection xmlns:intact="http://intact-project.org">
+            <intact:institution>Example University</intact:institution>
+            <intact:period>2020</intact:period>
+            <intact:euro>1500</intact:euro>
+            <intact:id_number type="doi">10.1234/ABC.42</intact:id_number>
+            <intact:id_number type="local">L-42</intact:id_number>
+        </intact:collection>
+    </metadata>
+</record>
+"""
+
+PROCESSING_INSTRUCTIONS = {
+    # Every variable in the generator is substituted
+    "'url':'%identifier%-%local_id%'": "oai:example.org:42-L-42",
+    "'url':'%local_id%/%local_id%'": "L-42/L-42",
+    # Generators without variables are copied verbatim
+    "'url':'fixed'": "fixed",
+    # Instructions which cannot be parsed are ignored
+    "url=%identifier%": "NA",
+    "'url':'fixed": "NA",
+}
+
+@pytest.mark.parametrize("processing, expected_url", PROCESSING_INSTRUCTIONS.items())
+def test_processing_instructions(processing, expected_url):
+    instruction = oat._parse_oai_processing_instruction(processing)
+    article = oat._extract_oai_article(ET.fromstring(OAI_RECORD), instruction)
+    assert article["url"] == expected_url
+    assert article["doi"] == "10.1234/abc.42"
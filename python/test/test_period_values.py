@@ -0,0 +1,51 @@
+# -*- coding: UTF-8 -*-
+
+import os
+from sys import path
+
+import pytest
+
+path.append(os.path.join(path[0], "python"))
+import openapc_toolkit as oat
+
+PERIOD_DATES = [
+    "2020-01",
+    "2020-12",
+    "2020-10-01",
+    "2020-12-31",
+    "2020-19-39", # Month and day digits are only roughly checked
+]
+
+NO_PERIOD_DATES = [
+    "",
+    "2020",
+    "2020-1",
+    "2020-21",
+    "2020-01-4",
+    "2020-01-4x",
+    "2020-01-41",
+    "2020-01-01T",
+    "2020/01",
+    "2020-01/01",
+    "20a0-01",
+    "-2020-01",
+    "2020-01\n",
+    "2020-01-01\n",
+    " 2020-01",
+]
+
+@pytest.mark.parametrize("value", PERIOD_DATES)
+def test_period_dates(value):
+    assert oat._is_period_date(value)
+
+@pytest.mark.parametrize("value", NO_PERIOD_DATES)
+def test_no_period_dates(value):
+    assert not oat._is_period_date(value)
+
+@pytest.mark.parametrize("value", PERIOD_DATES)
+def test_period_dates_reduced_to_year(value):
+    assert oat._process_period_value(value, 1) == value[:4]
+
+@pytest.mark.parametrize("value", NO_PERIOD_DATES)
+def test_other_period_values_unchanged(value):
+    assert oat._process_period_value(value, 1) == value